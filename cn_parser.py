@@ -9,8 +9,15 @@ Author: Arthur Boffelli Castro
 """
 
 import os
+import re
+import mmap
+import operator
 import argparse
-import platform
+import sys
+from array import array
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 ###############################################################################
 # Argparse section
@@ -49,39 +56,29 @@ parser.add_argument(
         )
 
 
-args = parser.parse_args()
+# columns that must be present in the Copy Number Data file.
+COLUMNS = ('Chromosome', 'Start', 'End', 'Cn')
+# buffer size used to write the output file (bytes).
+WRITE_BUFFER = 1 << 20
+# templates of the fragment and gap lines of the output.
+FRAGMENT_LINE = 'Fragment position\t%d-%d\tCn %d\n'
+GAP_LINE = 'Gap position\t%d-%d\tLength %d\n'
 
 ###############################################################################
 # Functions section
 
 
-def check_file(file):
+def check_file(header):
     """
     Function to check if the file is a Copy Number Data and has all the columns
         needed for the program.
     
-    :param file: file path (str)
+    :param header: column names of the file header (list)
 
-    :return: True if the file has the necessary conditions. If not, print a warning 
-        message and return False.
+    :return: True if all the necessary columns are present, False if not.
     """
-    with open(file, 'r') as infile:
-        # reads the first line and transform it into a list.
-        header = infile.readline().split() 
-        # words that must be present in the file
-        check_words = ['Chromosome', 'Start', 'End', 'Cn']
-        for word in check_words:
-            # if the word is found in the list continue to the other words
-            if word in header: continue
-            else:
-                # if the word is not present, print message and break the loop
-                print('Warning: The file "{}" is not in the right format.'\
-                      .format(file.split('/')[-1]))
-                break
-        # Else statement only executed if the loop did not break (all words are
-        #   present).
-        else: 
-            return True
+    # a single set comparison checks all the columns at once.
+    return set(header).issuperset(COLUMNS)
 
 
 def chr_set(string):
@@ -119,153 +116,238 @@ def chr_set(string):
     return chr_set
 
 
-def find_fragments(file):
+def find_fragments(file, target):
     """
-    Function that will look for the target chromosome(s) and write the 
-        information to the output.
+    Function that will look for the target chromosome(s) and return the 
+        information to be written in the output.
         
     :param file: file path (str)
+    :param target: target chromosomes encoded as bytes (set)
 
-    :return: print the information in the output. 
+    :return: text with the information of the fragments (str). Raise 
+        ValueError if the file is not in the right format or has an invalid
+        line.
     """
     # remove the whole path of the file name.
-    file_name = file.replace('\\', '/').split('/')[-1]
-    # call the function to create the set of target chromosomes.
-    target = chr_set(args.tg_chr)
-    # creates an empty dictionary and a fragment flag.
-    frag_dict = {}
+    file_name = os.path.basename(file)
+    # creates an empty dictionary, each new key starts with three empty arrays
+    #   (start positions, end positions and copy numbers).
+    frag_dict = defaultdict(segment_arrays)
+    # flag that marks if any chromosome of the file had fragments.
     frag = False
-    with open(file, 'r') as file:
-        for line in file:
-            # creates a list with the line.
-            line_list = line.strip().split('\t')
-            # check if the chromosome of the line is in the target set.
-            if line_list[0] in target:
-                # checks if the chromosome was already added to the dictionary,
-                #   avoiding overwriting keys.
-                if line_list[0] not in frag_dict:
-                    # create a new key with the chr and a list containing a 
-                    #   sublist [start, end, copy number] as value.
-                    frag_dict[line_list[0]] = [[int(line_list[1]),
-                                  int(line_list[2]), int(line_list[-3])]]
+    # the lines are kept in a list and joined in a single string at the end,
+    #   so the files can be processed in separate processes.
+    output = []
+    # open in binary mode, the lines are only split and never decoded to text.
+    with open(file, 'rb') as file:
+        # find the position of the needed columns by the header names, instead
+        #   of relying on fixed positions.
+        header_line = file.readline()
+        header = header_line.decode(errors='replace').rstrip(
+            '\r\n').split('\t')
+        # check the header already read, instead of opening the file again.
+        if not check_file(header):
+            raise ValueError('The file "{}" is not in the right format.'
+                             .format(file_name))
+        chr_col, start_col, end_col, cn_col = [header.index(word)
+                                               for word in COLUMNS]
+        # the lines are only split until the last column needed.
+        last_col = max(chr_col, start_col, end_col, cn_col)
+        # map the file in memory, the lines are read directly from the page
+        #   cache without copying the file to a read buffer.
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # compiled pattern that matches the beginning of a line of any 
+            #   target chromosome, the regex engine skips all the other lines
+            #   without returning to Python.
+            target_line = re.compile(
+                rb'^(?:[^\t\n]*\t){%d}(?:%s)(?=\t|\r?$)' % (
+                    chr_col, b'|'.join(map(re.escape, target))),
+                re.MULTILINE)
+            # start the search after the header.
+            position = len(header_line)
+            # chromosome of the previous line and its list of segments (None
+            #   if it is not a target).
+            last_chr = None
+            segments = None
+            while True:
+                # jump to the next line of a target chromosome.
+                match = target_line.search(data, position)
+                if match is None:
+                    break
+                data.seek(match.start())
+                for line in iter(data.readline, b''):
+                    # creates a list with the line, the columns after the 
+                    #   last one needed are left together and never split.
+                    line_list = line.split(b'\t', last_col + 1)
+                    # only the chromosome can end with the line break, the 
+                    #   int conversion already ignores it in the numbers. 
+                    #   Blank or short lines without the chromosome column
+                    #   are skipped like any line that is not a target.
+                    if len(line_list) > chr_col:
+                        chromosome = line_list[chr_col].rstrip(b'\r\n')
+                    else:
+                        chromosome = None
+                    # the segments of a chromosome are in consecutive lines, 
+                    #   so the target set is only checked when the chromosome
+                    #   changes.
+                    if chromosome != last_chr:
+                        last_chr = chromosome
+                        segments = (frag_dict[chromosome] 
+                                    if chromosome in target else None)
+                    # at the first line that is not a target, go back to the
+                    #   pattern search.
+                    if segments is None:
+                        break
+                    # add the start, end and copy number to the chromosome
+                    #   arrays. A missing, non-numeric or too large value is
+                    #   reported with the file name, like a wrong header.
+                    try:
+                        segments[0].append(int(line_list[start_col]))
+                        segments[1].append(int(line_list[end_col]))
+                        segments[2].append(int(line_list[cn_col]))
+                    except (IndexError, ValueError, OverflowError):
+                        raise ValueError(
+                            'The file "{}" has an invalid line: {}'.format(
+                                file_name, line.decode(errors='replace')
+                                .rstrip('\r\n'))) from None
                 else:
-                    # if the key alredy exists (fragment), add a new sublist 
-                    #   to the value list.
-                    frag_dict[line_list[0]].append([int(line_list[1]),
-                                  int(line_list[2]), int(line_list[-3])])
+                    # end of the file.
+                    break
+                position = data.tell()
     # After all the lines were read, start a loop through all the keys in the
     #   dict.
     for key in frag_dict:
-        # if the length of the value list is bigger than 1, it means that the
-        #   chromosome has fragments (print the information).
-        if len(frag_dict[key]) > 1:
-            # The fragment flag becomes True.
-            frag = True
-            # create a new list with the gap length between segments.
-            frag_list = gap_length(frag_dict[key])
-            # write in the output 'file name, chromosome, number of fragments'
-            outfile.write('{} {}\t{} fragments\n'.format(file_name, key,
-                          len(frag_dict[key])))
-            # loop through all the objects in the new list.
-            for frag in frag_list:
-                # If not an int (fragment position).
-                if type(frag) is not int:
-                    # write the information in the output.
-                    outfile.write('Fragment position\t{}-{}\tCn {}\n'.format(
-                            frag[0], frag[1], frag[2]))
-                else: # if is an int (gap length)
-                    # retrive the start and the end of the gap.
-                    gap_start = frag_list[frag_list.index(frag) - 1][1]
-                    gap_end = frag_list[frag_list.index(frag) + 1][0]
-                    # write the information in the output.
-                    outfile.write('Gap position\t{}-{}\tLength {}\n'.format(
-                        gap_start, gap_end, frag))
-            # print a black line between chromosomes 
-            # (1 blank line between chromosomes in the same file).
-            outfile.write('\n')
+        starts, ends, cns = frag_dict[key]
+        # if there is only one segment the chromosome has no fragments, 
+        #   nothing is printed.
+        if len(starts) < 2:
+            continue
+        # The fragment flag becomes True.
+        frag = True
+        # create a list with the gap length between segments.
+        gaps = gap_length(starts, ends)
+        # write in the output 'file name, chromosome, number of fragments'
+        output.append(f'{file_name} {key.decode()}\t{len(starts)} fragments\n')
+        # write each fragment followed by the gap to the next fragment, the
+        #   gap goes from the end of the fragment to the start of the next.
+        for i, gap in enumerate(gaps):
+            output.append(FRAGMENT_LINE % (starts[i], ends[i], cns[i]))
+            output.append(GAP_LINE % (ends[i], starts[i + 1], gap))
+        # the last fragment has no gap after it.
+        output.append(FRAGMENT_LINE % (starts[-1], ends[-1], cns[-1]))
+        # print a black line between chromosomes 
+        # (1 blank line between chromosomes in the same file).
+        output.append('\n')
 
     if frag:
         # print a blank line between files (2 blank lines between files) 
         # (only if the file had fragments), avoid stacking blank lines.
-        outfile.write('\n')
-        frag = False
+        output.append('\n')
+
+    return ''.join(output)
 
 
-def gap_length(fragment_list):
+def gap_length(starts, ends):
     """
-    Function that calculates the fragment length and add the value between the
-        two segments.
+    Function that calculates the gap length between each pair of consecutive 
+        fragments.
     
-   :param fragment_list: list containing sublists with information about 
-        the fragments of one chromosome. (list)
+    :param starts: start positions of the fragments of one chromosome (array)
+    :param ends: end positions of the fragments of one chromosome (array)
+
+    :return: list containing the gap length after each fragment, except the 
+        last one.
+    """
+    # subtract the end position of each fragment from the start position of 
+    #   the next fragment, all at once.
+    return list(map(operator.sub, starts[1:], ends))
+
+
+def segment_arrays():
+    """
+    Function to create the arrays that store the segments of one chromosome.
+        Each value is kept in a typed array instead of a list of lists, which
+        uses much less memory for large files.
+
+    :return: tuple with the arrays of start positions, end positions and copy
+        numbers.
+    """
+    return array('q'), array('q'), array('q')
 
-    :return: list containing the fragment information and the gap information 
-        (length and position) between each fragment.
+
+def write_fragments(file_list, target, out):
     """
-    # create a copy of the list given as an argument (avoids error in the loop)
-    gaps_list = fragment_list.copy()
-    # loop in a range of the size of the list. 1 is subtracted to avoid errors
-    # in the index position.
-    for i in range(len(fragment_list)-1):
-        # calculate the gap length by subtracting the start position of a 
-        # fragment and the end position of the fragment before.
-        gap = fragment_list[i+1][0] - fragment_list[i][1]
-        # calculate the position of the gap in the list by the index postion
-        # of the first segment plus 1.
-        position = gaps_list.index(fragment_list[i]) + 1
-        # insert the gap in the copy list between the both fragments.
-        gaps_list.insert(position, gap)
-
-    return gaps_list
+    Function that searches the target chromosome(s) in all the files and 
+        writes the information to the output.
+
+    :param file_list: paths of the files that will be searched (list)
+    :param target: target chromosomes encoded as bytes (set)
+    :param out: opened output file (file object)
+
+    :return: write the information in the output.
+    """
+    # a single file (or none) is searched in this process, starting the
+    #   worker processes would take longer than the search itself.
+    if len(file_list) < 2:
+        for file in file_list:
+            try:
+                out.write(find_fragments(file, target))
+            except (OSError, ValueError) as error:
+                print('Warning: {}'.format(error))
+        return
+    # the files are independent, so several files are searched at the same 
+    #   time in different processes, never more processes than files. The 
+    #   results are written in the same order as the files in the list.
+    workers = min(len(file_list), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(find_fragments, file, target)
+                   for file in file_list]
+        for future in futures:
+            # each file is opened only once, a missing or unreadable file and
+            #   a file in the wrong format are reported by the errors raised.
+            try:
+                out.write(future.result())
+            except (OSError, ValueError) as error:
+                print('Warning: {}'.format(error))
 
 
 ###############################################################################
 # Running Code
 
-infile = args.infile
-
-# If the output file is not informed
-if not args.outfile:
-    # check which operating system the user is using.
-    if platform.system() == 'Linux':
-        # if Linux the stdout path for Linux becomes the outfile
-        outfile = '/dev/stdout'
-    elif platform.system() == 'Windows':
-        # if Windows the stdout path for Windows becomes the outfile
-        outfile = '\CON'
-    # I could not find the path of stdout for Mac. If Mac the program will not
-    # print in the screen.
-else: # if the outfile was informed.
-    outfile = args.outfile
-
-# open the file
-with open(outfile, 'w') as outfile:
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    infile = args.infile
+    # create the set of target chromosomes only once for all the files, encoded
+    #   to be compared directly with the bytes read from the files.
+    TARGET = frozenset(chromosome.encode() 
+                       for chromosome in chr_set(args.tg_chr))
+
+    # list of the files that will be searched.
+    file_list = []
     # if a directory was passed as input
     if args.fold_path:
         # check the directory existance.
         if os.path.isdir(args.fold_path):
-            # transform all the directory files into a list.
-            file_list = os.listdir(args.fold_path)
-            # loop through all the files in the list
-            for file in file_list:
-                # adds the folder path to the file name, to avoid errors if the
-                # program is not in the same directory.
-                file = args.fold_path + file
-                # check if the file exists with file_existance function
-                if file_existance(file):
-                    # check if the file is Copy Number Data with check_file 
-                    # function
-                    if check_file(file):
-                        # finally call the function to find the fragments.
-                        find_fragments(file)
+            # transform all the directory files into a list. The entry paths
+            #   already include the folder, with or without the '/' at the 
+            #   end, and sub-directories are skipped.
+            with os.scandir(args.fold_path) as entries:
+                file_list = [entry.path for entry in entries 
+                             if entry.is_file()]
     # if a single file was passed as input
     if infile:
-        # check if the file exists
-        if os.path.exists(infile):
-             # check if the file is Copy Number Data with check_file function
-            if check_file(infile):
-                # finally call the function to find the fragments.
-                find_fragments(infile)
-
-# print the message 'Done', to confirm that the program is over.
-print('Done!')
+        file_list = [infile]
+
+    # open the output file if it was informed, if not the result is printed
+    #   on the standard output (which must not be closed at the end).
+    if args.outfile:
+        output = open(args.outfile, 'w', buffering=WRITE_BUFFER)
+    else:
+        output = nullcontext(sys.stdout)
+
+    with output as out:
+        write_fragments(file_list, TARGET, out)
+
+    # print the message 'Done', to confirm that the program is over.
+    print('Done!')